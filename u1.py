@@ -1,6 +1,9 @@
 import os
 import shutil
-import random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils_core import MANIFEST_NAME, MANIFEST_HEADER, BOX_CROP_NAME
 
 def create_dataset_structure(base_dir):
     """
@@ -10,57 +13,99 @@ def create_dataset_structure(base_dir):
         for category in ['fall', 'no_fall']:
             os.makedirs(os.path.join(base_dir, split, category), exist_ok=True)
 
-def collect_images_from_dirs(directories, extensions=('.jpg', '.png')):
+def _place(src, dst):
+    """
+    Place src at dst as a hard link, falling back to a copy across filesystems.
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # Re-running the split replaces the file left by the previous run, as shutil.copy did
+        os.remove(dst)
+        _place(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+def _iter_manifests(directory):
+    """
+    Recursively yield the labels.csv manifest paths under directory using os.scandir, which avoids a stat() per entry.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_manifests(entry.path)
+            elif entry.name == MANIFEST_NAME:
+                yield entry.path
+
+def collect_manifests_from_dirs(directories):
     """
-    Collect images from multiple directories with specified extensions.
+    Collect the labels.csv manifests written by code/data.py from multiple directories.
     
     Args:
-        directories: List of directories to collect images from.
-        extensions: Tuple of allowed image file extensions.
+        directories: List of directories to collect manifests from.
     
     Returns:
-        List of image file paths.
+        Tuple of an array of crop image paths and an (N, 7) array of the matching
+        frame_num, box, x_center, y_center, width, height, is_fall manifest rows.
+    
+    Raises:
+        ValueError: If a manifest belongs to crops saved as tar shards or npy tensors.
     """
-    files = []
+    paths = []
+    rows = []
     for directory in directories:
-        for root, _, filenames in os.walk(directory):  # Recursively walk through directories
-            for file in filenames:
-                if file.lower().endswith(extensions):
-                    files.append(os.path.join(root, file))
-        print(f"Found {len(files)} images in {directory}")
-    return files
-
-def split_data(source_fall_dirs, source_no_fall_dirs, dest_base_dir, train_ratio=0.7, val_ratio=0.15):
+        # A room that has not been cropped yet has no directory; skip it as os.walk did
+        try:
+            manifests = list(_iter_manifests(directory))
+        except FileNotFoundError:
+            manifests = []
+        for manifest in manifests:
+            labels = np.loadtxt(manifest, delimiter=',', dtype=np.int32, skiprows=1, ndmin=2).reshape(-1, 7)
+            prefix = os.path.join(os.path.dirname(manifest), '')
+            crops = [prefix + BOX_CROP_NAME.format(frame_num=frame_num, box=box) for frame_num, box in labels[:, :2].tolist()]
+            # code/data.py also writes manifests next to tar shards and npy tensors, which have no crop files
+            if crops and not os.path.isfile(crops[0]):
+                raise ValueError(f"{manifest} does not describe jpg crops ({crops[0]} is missing); run code/data.py with output_format='jpg'")
+            paths.extend(crops)
+            rows.append(labels)
+        print(f"Found {len(paths)} labeled crops in {directory}")
+    rows = np.concatenate(rows) if rows else np.empty((0, 7), dtype=np.int32)
+    return np.array(paths, dtype=object), rows
+
+def split_data(source_dirs, dest_base_dir, train_ratio=0.7, val_ratio=0.15, materialize=False, max_workers=32):
     """
-    Split the data from multiple fall and no_fall directories into train, val, and test directories.
+    Split the labeled crops from multiple directories into train, val, and test manifests.
+
+    The split only writes train.csv, val.csv and test.csv (path plus the manifest columns) to
+    dest_base_dir; no image is moved. With materialize=True the crops are also placed into
+    train/val/test fall and no_fall directories for loaders that read labels from the layout.
     
     Args:
-        source_fall_dirs: List of directories containing fall frames
-        source_no_fall_dirs: List of directories containing no_fall frames
+        source_dirs: List of directories containing cropped frames and their labels.csv manifests
         dest_base_dir: Destination directory to store the train, val, test split
         train_ratio: Ratio of data to be used for training
         val_ratio: Ratio of data to be used for validation
+        materialize: Whether to also place the images into per split and category directories
+        max_workers: Number of threads used to place files
     """
-    # Collect all fall and no_fall frames from multiple directories
-    fall_files = collect_images_from_dirs(source_fall_dirs)
-    no_fall_files = collect_images_from_dirs(source_no_fall_dirs)
+    # Collect all labeled frames from multiple directories
+    paths, rows = collect_manifests_from_dirs(source_dirs)
+    is_fall = rows[:, 6] == 1
+    fall_idx = np.flatnonzero(is_fall)
+    no_fall_idx = np.flatnonzero(~is_fall)
 
     # Debugging: Check if files exist in both categories
-    if len(no_fall_files) == 0:
-        print("No files found in no_fall directories!")
+    if len(no_fall_idx) == 0:
+        print("No no_fall frames found in manifests!")
         return
 
-    if len(fall_files) == 0:
-        print("No files found in fall directories!")
+    if len(fall_idx) == 0:
+        print("No fall frames found in manifests!")
         return
 
-    # Shuffle the data
-    random.shuffle(fall_files)
-    random.shuffle(no_fall_files)
-
     # Compute split sizes
-    total_fall = len(fall_files)
-    total_no_fall = len(no_fall_files)
+    total_fall = len(fall_idx)
+    total_no_fall = len(no_fall_idx)
 
     train_fall = int(train_ratio * total_fall)
     val_fall = int(val_ratio * total_fall)
@@ -68,60 +113,63 @@ def split_data(source_fall_dirs, source_no_fall_dirs, dest_base_dir, train_ratio
     train_no_fall = int(train_ratio * total_no_fall)
     val_no_fall = int(val_ratio * total_no_fall)
 
-    # Split fall data
-    train_fall_files = fall_files[:train_fall]
-    val_fall_files = fall_files[train_fall:train_fall + val_fall]
-    test_fall_files = fall_files[train_fall + val_fall:]
-
-    # Split no_fall data
-    train_no_fall_files = no_fall_files[:train_no_fall]
-    val_no_fall_files = no_fall_files[train_no_fall:train_no_fall + val_no_fall]
-    test_no_fall_files = no_fall_files[train_no_fall + val_no_fall:]
+    # Shuffle the row indices of each class and split them
+    train_fall_idx, val_fall_idx, test_fall_idx = np.split(np.random.permutation(fall_idx), [train_fall, train_fall + val_fall])
+    train_no_fall_idx, val_no_fall_idx, test_no_fall_idx = np.split(np.random.permutation(no_fall_idx), [train_no_fall, train_no_fall + val_no_fall])
 
     # Debug: Print split sizes
-    print(f"Training set: {len(train_fall_files)} fall, {len(train_no_fall_files)} no_fall")
-    print(f"Validation set: {len(val_fall_files)} fall, {len(val_no_fall_files)} no_fall")
-    print(f"Test set: {len(test_fall_files)} fall, {len(test_no_fall_files)} no_fall")
-
-    # Move files into the appropriate directories
-    for file in train_fall_files:
-        shutil.copy(file, os.path.join(dest_base_dir, 'train', 'fall', os.path.basename(file)))
-    
-    for file in val_fall_files:
-        shutil.copy(file, os.path.join(dest_base_dir, 'val', 'fall', os.path.basename(file)))
-
-    for file in test_fall_files:
-        shutil.copy(file, os.path.join(dest_base_dir, 'test', 'fall', os.path.basename(file)))
-
-    for file in train_no_fall_files:
-        shutil.copy(file, os.path.join(dest_base_dir, 'train', 'no_fall', os.path.basename(file)))
-
-    for file in val_no_fall_files:
-        shutil.copy(file, os.path.join(dest_base_dir, 'val', 'no_fall', os.path.basename(file)))
-
-    for file in test_no_fall_files:
-        shutil.copy(file, os.path.join(dest_base_dir, 'test', 'no_fall', os.path.basename(file)))
-
-# Paths to your current folders with fall and no_fall frames for multiple categories
-source_fall_dirs = [
-    'datasets/FDD/Coffee_room_01/Videos_with_fall_frames/',
-    'datasets/FDD/Coffee_room_02/Videos_with_fall_frames/',
-    'datasets/FDD/Home_01/Videos_with_fall_frames/',
-    'datasets/FDD/Home_02/Videos_with_fall_frames/'
-]
+    print(f"Training set: {len(train_fall_idx)} fall, {len(train_no_fall_idx)} no_fall")
+    print(f"Validation set: {len(val_fall_idx)} fall, {len(val_no_fall_idx)} no_fall")
+    print(f"Test set: {len(test_fall_idx)} fall, {len(test_no_fall_idx)} no_fall")
+
+    # Write one manifest per split
+    os.makedirs(dest_base_dir, exist_ok=True)
+    splits = {
+        'train': np.concatenate([train_fall_idx, train_no_fall_idx]),
+        'val': np.concatenate([val_fall_idx, val_no_fall_idx]),
+        'test': np.concatenate([test_fall_idx, test_no_fall_idx]),
+    }
+    for split, idx in splits.items():
+        np.savetxt(os.path.join(dest_base_dir, f"{split}.csv"), np.column_stack([paths[idx], rows[idx]]),
+                   fmt='%s', delimiter=',', header=f"path,{MANIFEST_HEADER}", comments='')
+
+    if not materialize:
+        return
 
-source_no_fall_dirs = [
-    'datasets/FDD/Coffee_room_01/Videos_with_no_fall_frames/',
-    'datasets/FDD/Coffee_room_02/Videos_with_no_fall_frames/',
-    'datasets/FDD/Home_01/Videos_with_no_fall_frames/',
-    'datasets/FDD/Home_02/Videos_with_no_fall_frames/'
+    # Place files into the appropriate directories (hard links, so no image bytes are copied).
+    # Crop and video names repeat across rooms, so each crop is named after its whole path
+    # below the directory shared by all sources, e.g. Home_01_Videos_with_labeled_frames_video (1)_12_0.jpg
+    create_dataset_structure(dest_base_dir)
+    root = os.path.commonpath([os.path.abspath(directory) for directory in source_dirs])
+    pairs = [
+        (path, os.path.join(dest_base_dir, split, 'fall' if fall else 'no_fall', os.path.relpath(os.path.abspath(path), root).replace(os.sep, '_')))
+        for split, idx in splits.items()
+        for path, fall in zip(paths[idx].tolist(), is_fall[idx].tolist())
+    ]
+
+    # Two crops with the same destination would silently replace each other
+    destinations = set()
+    for path, dst in pairs:
+        if dst in destinations:
+            raise ValueError(f"More than one crop would be placed at {dst}, the last one being {path}")
+        destinations.add(dst)
+
+    # Placement is I/O bound, so overlap the syscalls with a thread pool
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda pair: _place(*pair), pairs))
+
+# Paths to your current folders with labeled frames for multiple categories
+source_dirs = [
+    'datasets/FDD/Coffee_room_01/Videos_with_labeled_frames/',
+    'datasets/FDD/Coffee_room_02/Videos_with_labeled_frames/',
+    'datasets/FDD/Home_01/Videos_with_labeled_frames/',
+    'datasets/FDD/Home_02/Videos_with_labeled_frames/'
 ]
 
 # Destination base directory for the new structure
 dest_base_dir = 'fall_detection_data'
 
-# Create the dataset folder structure
-create_dataset_structure(dest_base_dir)
-
-# Split and move the data
-split_data(source_fall_dirs, source_no_fall_dirs, dest_base_dir)
+# Split the data into train, val and test manifests, and place the crops into the
+# train/val/test fall and no_fall directories that the training notebooks load with
+# flow_from_directory and ImageFolder
+split_data(source_dirs, dest_base_dir, materialize=True)
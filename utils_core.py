@@ -0,0 +1,422 @@
+'''Frame decoding and cropping shared by utils.py and code/data.py.'''
+import io
+import os
+import re
+import tarfile
+import warnings
+import cv2 as cv
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    from turbojpeg import TJSAMP_420, TurboJPEG
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG is not installed or cannot find libturbojpeg
+    _turbo_jpeg = None
+
+# Fallback keyframe interval when the container does not report one
+DEFAULT_GOP_SIZE = 30
+# Number of libavcodec threads used when decoding with PyAV
+DECODE_THREADS = os.cpu_count() or 1
+# Number of background threads writing encoded crops to disk for each video
+WRITE_THREADS = 4
+# JPEG quality of the saved crops (matches the cv.imwrite default)
+JPEG_QUALITY = 95
+# Size at which a tar shard is closed and the next one started
+SHARD_SIZE = 1 << 30
+# Per-video manifest written next to the crops by code/data.py and read by u1.py
+MANIFEST_NAME = "labels.csv"
+MANIFEST_HEADER = "frame_num,box,x_center,y_center,width,height,is_fall"
+# Crop names used with the manifest, one file per box; box numbers the boxes of a frame from 0 in annotation order
+BOX_CROP_NAME = "{frame_num}_{box}.jpg"
+# A bounding box line: frame_num, (unused), x_center, y_center, width, height, then optionally more fields
+ANNOTATION_LINE = re.compile(rb"\s*(-?\d+)\s*,[^,]*,\s*(-?\d+)\s*,\s*(-?\d+)\s*,\s*(-?\d+)\s*,\s*(-?\d+)\s*(?:,.*)?$")
+
+def get_gop_size(video):
+    '''Return the keyframe interval of an opened video, or DEFAULT_GOP_SIZE if it cannot be probed.'''
+    gop_size = int(video.get(cv.CAP_PROP_GOP_SIZE)) if hasattr(cv, "CAP_PROP_GOP_SIZE") else 0
+    return gop_size if gop_size > 0 else DEFAULT_GOP_SIZE
+
+def _read_frames_cv(video_path, frame_nums):
+    '''Yield (frame_num, frame) for the sorted frame numbers using cv.VideoCapture.'''
+    video = cv.VideoCapture(video_path)
+    if not video.isOpened():
+        print(f"Cannot open video {video_path}")
+        return
+
+    # Seeking with CAP_PROP_POS_FRAMES re-decodes from the previous keyframe on every call,
+    # so advance with grab() and only decode (retrieve) the frames that are annotated.
+    # Annotations closer together than one GOP form a cluster that is grabbed through;
+    # a seek is only issued to jump to the start of the next cluster.
+    gop_size = get_gop_size(video)
+    grabbed = 0
+    try:
+        for frame_num in frame_nums:
+            if frame_num - grabbed > gop_size:
+                video.set(cv.CAP_PROP_POS_FRAMES, frame_num - 1)
+                grabbed = frame_num - 1
+            while grabbed < frame_num and video.grab():
+                grabbed += 1
+            ret, frame = False, None
+            if grabbed == frame_num:
+                ret, frame = video.retrieve()
+            yield frame_num, frame if ret else None
+    finally:
+        video.release()
+
+def _decode_av(container, stream, video_path):
+    '''Yield the decoded frames of stream, skipping the packets that fail to decode.'''
+    try:
+        for packet in container.demux(stream):
+            # Decode packet by packet, so a corrupt packet only loses its own frames
+            try:
+                frames = packet.decode()
+            except av.error.FFmpegError as e:
+                print(f"Skipping undecodable packet in {video_path}: {e}")
+                continue
+            yield from frames
+    except av.error.FFmpegError as e:
+        print(f"Error reading {video_path}: {e}")
+
+def _read_frames_av(video_path, frame_nums, scale=1.0):
+    '''Yield (frame_num, frame) for the sorted frame numbers using PyAV's multi-threaded decoder.
+
+    When scale < 1 the frames are downscaled by libswscale while converting to BGR, so full resolution
+    pixels are never materialized as an array.
+    '''
+    try:
+        container = av.open(video_path)
+    except av.error.FFmpegError:
+        print(f"Cannot open video {video_path}")
+        return
+
+    with container:
+        wanted = iter(frame_nums)
+        target = next(wanted, None)
+        if not container.streams.video:
+            print(f"No video stream in {video_path}")
+        else:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            stream.thread_count = DECODE_THREADS
+
+            for index, av_frame in enumerate(_decode_av(container, stream, video_path), start=1):
+                while target is not None and target < index:
+                    yield target, None
+                    target = next(wanted, None)
+                if target is None:
+                    break
+                # Only the annotated frames are converted to BGR arrays
+                if target == index:
+                    if scale < 1.0:
+                        av_frame = av_frame.reformat(width=round(av_frame.width * scale), height=round(av_frame.height * scale), format="bgr24")
+                    yield target, av_frame.to_ndarray(format="bgr24")
+                    target = next(wanted, None)
+
+        # Frames past the end of the stream
+        while target is not None:
+            yield target, None
+            target = next(wanted, None)
+
+def read_frames(video_path, frame_nums, scale=1.0):
+    '''Yield (frame_num, frame) for each of the sorted, 1-based frame numbers; frame is None if it cannot be read.
+
+    scale must come from get_decode_scale(), which only returns values below 1 when the decoder can resize.
+    '''
+    if av is not None:
+        return _read_frames_av(video_path, frame_nums, scale)
+    return _read_frames_cv(video_path, frame_nums)
+
+def get_decode_scale(boxes, image_size):
+    '''Return the factor frames can be downscaled by at decode time without any crop falling below image_size.
+
+    Only the PyAV decoder can resize while decoding, so this is 1.0 when PyAV is not installed.
+    '''
+    if av is None or len(boxes) == 0:
+        return 1.0
+    return min(1.0, image_size / int(boxes[:, 3:5].min()))
+
+def _parse_annotation_lines(annotation_path):
+    '''Parse the bounding box lines of an annotation file one at a time, skipping malformed lines.'''
+    rows = []
+    with open(annotation_path, "rb") as file:
+        for line_num, line in enumerate(file, start=1):
+            # First two lines are for fall start and end frames
+            if line_num <= 2:
+                continue
+            match = ANNOTATION_LINE.match(line)
+            if match is None:
+                if line.strip():
+                    print(f"Malformed annotation on line {line_num} in {annotation_path}: {line.strip().decode(errors='replace')}")
+                continue
+            rows.append(tuple(map(int, match.groups())))
+    return np.array(rows, dtype=np.int32).reshape(-1, 5)
+
+def load_annotations(annotation_path):
+    '''Load an annotation file into (fall_start_frame, fall_end_frame, boxes).
+
+    boxes is an (N, 5) int32 array of frame_num, x_center, y_center, width, height rows sorted by frame_num,
+    with boxes of non-positive width or height removed. Raises ValueError if the fall start or end frame is malformed.
+    '''
+    with open(annotation_path, "r") as file:
+        # First two lines are for fall start and end frames
+        fall_start_frame = int(file.readline())
+        fall_end_frame = int(file.readline())
+
+        # Remaining lines contain bounding box data, parsed in a single vectorized call
+        try:
+            # A file with no boxes is valid, so silence the empty input warning
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", message="loadtxt: (input contained no data|Empty input file)", category=UserWarning)
+                boxes = np.loadtxt(file, delimiter=",", dtype=np.int32, usecols=(0, 2, 3, 4, 5), ndmin=2).reshape(-1, 5)
+        except ValueError:
+            boxes = None
+
+    # loadtxt rejects the whole file on one bad line; re-parse line by line so only malformed lines are skipped
+    if boxes is None:
+        boxes = _parse_annotation_lines(annotation_path)
+
+    # Ensure bounding box values are valid
+    valid = (boxes[:, 3] > 0) & (boxes[:, 4] > 0)
+    if not valid.all():
+        print(f"Skipping {int((~valid).sum())} boxes with invalid dimensions in {annotation_path}")
+        boxes = boxes[valid]
+
+    # Sort by frame so the video can be walked once, front to back
+    boxes = boxes[np.argsort(boxes[:, 0], kind="stable")]
+    return fall_start_frame, fall_end_frame, boxes
+
+def get_crop_windows(boxes, frame_width, frame_height):
+    '''Return the (N, 4) x_start, y_start, x_end, y_end crop windows of the boxes clipped to the frame, and a mask of the non-empty ones.'''
+    x_center, y_center, width, height = boxes[:, 1], boxes[:, 2], boxes[:, 3], boxes[:, 4]
+    windows = np.stack([
+        np.clip(x_center - width // 2, 0, frame_width),
+        np.clip(y_center - height // 2, 0, frame_height),
+        np.clip(x_center + width // 2, 0, frame_width),
+        np.clip(y_center + height // 2, 0, frame_height),
+    ], axis=1)
+    valid = (windows[:, 2] > windows[:, 0]) & (windows[:, 3] > windows[:, 1])
+    return windows, valid
+
+def encode_jpeg(image):
+    '''Encode a BGR image to JPEG bytes, using TurboJPEG when it is available.'''
+    if _turbo_jpeg is not None:
+        # PyTurboJPEG defaults to 4:2:2 chroma subsampling, match the 4:2:0 that cv.imencode uses
+        return _turbo_jpeg.encode(image, quality=JPEG_QUALITY, jpeg_subsample=TJSAMP_420)
+    ret, buffer = cv.imencode(".jpg", image, [cv.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ret:
+        raise ValueError("JPEG encoding failed")
+    return buffer.tobytes()
+
+def _write_file(path, data):
+    '''Write encoded image bytes to path; runs on the writer threads.'''
+    with open(path, "wb") as file:
+        file.write(data)
+
+class _FileWriter:
+    '''Save every crop as its own file, writing from a small background thread pool.'''
+
+    def __init__(self, prefix, crop_name):
+        self._prefix = prefix
+        self._crop_name = crop_name
+        self._executor = ThreadPoolExecutor(max_workers=WRITE_THREADS)
+        self._writes = []
+
+    def write(self, frame_num, box, image):
+        path = self._prefix + self._crop_name.format(frame_num=frame_num, box=box)
+        self._writes.append((path, self._executor.submit(_write_file, path, encode_jpeg(image))))
+
+    def close(self):
+        '''Wait for the pending writes and return the positions, in write order, of the ones that failed.'''
+        self._executor.shutdown(wait=True)
+        failed = set()
+        for position, (path, future) in enumerate(self._writes):
+            if future.exception() is not None:
+                print(f"Error saving cropped frame {path}: {future.exception()}")
+                failed.add(position)
+        return failed
+
+class _ShardWriter:
+    '''Append crops to WebDataset-style tar shards (shard-000000.tar, ...) in the output directory.'''
+
+    def __init__(self, prefix, crop_name, shard_size=SHARD_SIZE):
+        self._prefix = prefix
+        self._crop_name = crop_name
+        self._shard_size = shard_size
+        # Open tar file, its shard index and the bytes written to it
+        self._tar, self._index, self._size = None, -1, 0
+
+    def write(self, frame_num, box, image):
+        data = encode_jpeg(image)
+        if self._tar is None or self._size + len(data) > self._shard_size:
+            if self._tar is not None:
+                self._tar.close()
+            self._index += 1
+            self._tar = tarfile.open(f"{self._prefix}shard-{self._index:06d}.tar", "w")
+            self._size = 0
+
+        info = tarfile.TarInfo(name=self._crop_name.format(frame_num=frame_num, box=box))
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        self._size += len(data)
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+
+class _TensorWriter:
+    '''Save the crops of the output directory as one float16 N x 3 x H x W RGB array scaled to [0, 1].
+
+    The array goes to crops.npy and the matching (N, 2) frame_num, box pairs to frames.npy, so training
+    can load the tensors directly instead of decoding JPEGs again.
+    '''
+
+    def __init__(self, prefix, crop_name):
+        # Crops are stored by position, so crop_name is not used
+        self._prefix = prefix
+        # (frame_num, box) of each crop
+        self._keys = []
+        # BGR crops
+        self._images = []
+
+    def write(self, frame_num, box, image):
+        self._keys.append((frame_num, box))
+        self._images.append(image)
+
+    def close(self):
+        if not self._images:
+            return
+        # BGR HWC uint8 -> RGB CHW float16
+        tensors = np.ascontiguousarray(np.stack(self._images)[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float16)
+        tensors *= np.float16(1 / 255)
+        np.save(self._prefix + "crops.npy", tensors)
+        np.save(self._prefix + "frames.npy", np.array(self._keys, dtype=np.int32).reshape(-1, 2))
+
+# Writers selected by the output_format argument of _crop_core
+_WRITERS = {"jpg": _FileWriter, "tar": _ShardWriter, "npy": _TensorWriter}
+
+def _crop_core(video_path, boxes, prefix, image_size=224, output_format="jpg", crop_name="{frame_num}.jpg"):
+    '''Crop, resize and save the boxes loaded by load_annotations.
+
+    prefix is the path prefix (the output directory, ending in a separator) every crop is saved under.
+    output_format selects how crops are stored under that prefix: "jpg" writes one JPEG file per crop,
+    "tar" appends them to WebDataset-style tar shards and "npy" saves a float16 tensor.
+    crop_name is formatted with frame_num and box to name each JPEG file or tar entry. When it has no {box}
+    field the jpg and tar formats only save the last valid box of each frame, as that crop would replace
+    the others; npy stores crops by position and keeps every box.
+    Returns the indices into boxes of the crops that were saved.
+    '''
+    if output_format not in _WRITERS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {sorted(_WRITERS)}")
+
+    # Let the decoder output frames that are only as large as the smallest crop needs,
+    # and map the boxes onto the downscaled frames
+    scale = get_decode_scale(boxes, image_size)
+    if scale < 1.0:
+        boxes = boxes.copy()
+        boxes[:, 1:] = np.rint(boxes[:, 1:] * scale)
+
+    # Each annotated frame is decoded once, even when several boxes share it
+    frame_nums, starts = np.unique(boxes[:, 0], return_index=True)
+    ends = np.append(starts[1:], len(boxes))
+    frames = read_frames(video_path, frame_nums.tolist(), scale)
+    windows = valid = None
+    saved = []
+    writer = _WRITERS[output_format](prefix, crop_name)
+    per_frame = output_format != "npy" and "{box}" not in crop_name
+
+    # Bind the per-crop calls to locals, the loop below runs once per box
+    cv_resize, write = cv.resize, writer.write
+    size = (image_size, image_size)
+    try:
+        for (frame_num, frame), start, end in zip(frames, starts, ends):
+            if frame is None:
+                print(f"Cannot read frame {frame_num} from {video_path}")
+                continue
+
+            # Every frame of a video has the same size, so clip all boxes against the first decoded frame at once
+            if windows is None:
+                height_frame, width_frame, _ = frame.shape
+                windows, valid = get_crop_windows(boxes, width_frame, height_frame)
+                windows, valid = windows.tolist(), valid.tolist()
+
+            # Walk the boxes of a frame backwards when only the last one is kept
+            for i in (range(end - 1, start - 1, -1) if per_frame else range(start, end)):
+                # Skip if the crop box is invalid
+                if not valid[i]:
+                    print(f"Invalid crop dimensions for frame {frame_num}, skipping.")
+                    continue
+
+                x_start, y_start, x_end, y_end = windows[i]
+
+                # Crop the frame; cv.resize reads the view directly, so no copy is needed
+                cropped = frame[y_start:y_end, x_start:x_end]
+                try:
+                    # Resize the cropped image; INTER_AREA gives better and faster results when shrinking,
+                    # but behaves like nearest neighbour when enlarging, so only use it if both sides shrink
+                    if x_end - x_start > image_size and y_end - y_start > image_size:
+                        interpolation = cv.INTER_AREA
+                    else:
+                        interpolation = cv.INTER_LINEAR
+                    cropped = cv_resize(cropped, size, interpolation=interpolation)
+                    write(frame_num, i - start, cropped)
+                    saved.append(i)
+                    if per_frame:
+                        break
+                except Exception as e:
+                    print(f"Error processing frame {frame_num}: {e}")
+    finally:
+        failed = writer.close()
+
+    # Only the file writer finishes its writes in the background, and only it reports failures
+    if failed:
+        saved = [i for position, i in enumerate(saved) if position not in failed]
+    return saved
+
+def list_annotation_files(annotation_path):
+    '''Map each video name to its annotation file by scanning annotation_path once; empty if the directory is missing.'''
+    try:
+        with os.scandir(annotation_path) as entries:
+            return {os.path.splitext(entry.name)[0]: entry.path for entry in entries if entry.name.endswith('.txt')}
+    except FileNotFoundError:
+        return {}
+
+def check_cpu_optimizations():
+    '''Print the SIMD baseline and dispatch of the installed OpenCV build and warn if AVX2 is unavailable.'''
+    build_info = cv.getBuildInformation()
+    optimizations = [line.strip() for line in build_info.splitlines() if line.strip().startswith(("Baseline:", "Dispatched code generation:"))]
+    for line in optimizations:
+        print(f"OpenCV {line}")
+    if "AVX2" not in " ".join(optimizations):
+        print("Warning: this OpenCV build has no AVX2 code paths; resize will run on slower SIMD paths")
+
+def _init_worker(threads_per_worker=1):
+    '''Split the CPU between worker processes so parallel videos do not oversubscribe it.
+
+    OpenCV's parallel_for_ (used by resize, whatever its threading backend) and the PyAV decoder each get
+    threads_per_worker threads.
+    '''
+    global DECODE_THREADS
+    cv.setNumThreads(threads_per_worker)
+    DECODE_THREADS = threads_per_worker
+
+def run_tasks(crop_fn, tasks, max_workers=None):
+    '''Run crop_fn on every task tuple, one video per worker process.
+
+    crop_fn must be a module-level function so it can be sent to the workers.
+    '''
+    check_cpu_optimizations()
+
+    # Each video is independent, so spread them over a process pool and give
+    # any cores left over by the pool to OpenCV's threads inside each worker
+    cpu_count = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers or cpu_count, len(tasks)))
+    threads_per_worker = max(1, cpu_count // max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(threads_per_worker,)) as executor:
+        list(executor.map(crop_fn, tasks))